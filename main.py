@@ -4,13 +4,61 @@ A FastAPI REST API for managing urban sensor data and city metrics
 Author: Arnau Ropero
 """
 
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+from fastapi_cache.backends.redis import RedisBackend
+from fastapi_cache.coder import PickleCoder
+from fastapi_cache.decorator import cache
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, field_validator
 from typing import Optional, List
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from enum import Enum
-import uvicorn
+from contextlib import asynccontextmanager
+import asyncio
+import os
+import time
+import orjson
+import redis.asyncio as aioredis
+
+from storage import InMemoryStorage, RedisStorage
+
+# Share state through Redis when REDIS_URL is set, otherwise keep it in memory
+REDIS_URL = os.environ.get("REDIS_URL")
+storage = RedisStorage.from_url(REDIS_URL) if REDIS_URL else InMemoryStorage()
+
+# Namespace for cached metrics responses, cleared whenever sensors change
+METRICS_CACHE_NAMESPACE = "metrics"
+
+# Timestamps are integer milliseconds since the Unix epoch on the wire
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+# Coarse clock for response timestamps, refreshed every 100 ms
+_now_cached = now_ms()
+
+async def _tick_clock():
+    global _now_cached
+    while True:
+        _now_cached = now_ms()
+        await asyncio.sleep(0.1)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Cache in Redis too when available, so invalidation reaches every worker
+    if REDIS_URL:
+        cache_backend = RedisBackend(aioredis.from_url(REDIS_URL))
+    else:
+        cache_backend = InMemoryBackend()
+    FastAPICache.init(cache_backend, prefix="smart-cities-api")
+    
+    await init_sample_data()
+    clock_task = asyncio.create_task(_tick_clock())
+    yield
+    clock_task.cancel()
+    await storage.close()
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -20,17 +68,52 @@ app = FastAPI(
     contact={
         "name": "Arnau Ropero",
         "email": "arnauroperouab@gmail.com",
-    }
+    },
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
-# Enable CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Enable CORS for every origin with fixed headers, no per-request origin matching
+_CORS_ALLOW_ORIGIN = (b"access-control-allow-origin", b"*")
+_CORS_PREFLIGHT_HEADERS = [
+    _CORS_ALLOW_ORIGIN,
+    (b"access-control-allow-methods", b"DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"),
+    (b"access-control-max-age", b"600"),
+    (b"content-length", b"2"),
+    (b"content-type", b"text/plain; charset=utf-8"),
+]
+
+class PublicCORSMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        # Answer preflight requests directly, allowing any requested headers
+        if scope["method"] == "OPTIONS":
+            headers = dict(scope["headers"])
+            if b"access-control-request-method" in headers:
+                response_headers = list(_CORS_PREFLIGHT_HEADERS)
+                if b"access-control-request-headers" in headers:
+                    response_headers.append((b"access-control-allow-headers", headers[b"access-control-request-headers"]))
+                await send({"type": "http.response.start", "status": 200, "headers": response_headers})
+                await send({"type": "http.response.body", "body": b"OK"})
+                return
+        
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), _CORS_ALLOW_ORIGIN]
+            await send(message)
+        
+        await self.app(scope, receive, send_with_cors)
+
+app.add_middleware(PublicCORSMiddleware)
+
+# Compress larger responses (sensor lists, readings)
+app.add_middleware(GZipMiddleware, minimum_size=1000, compresslevel=5)
 
 # Enums for sensor types
 class SensorType(str, Enum):
@@ -51,12 +134,12 @@ class SensorStatus(str, Enum):
 
 # Pydantic models
 class SensorBase(BaseModel):
-    name: str = Field(..., example="Temperature Sensor Plaza Catalunya")
+    name: str = Field(..., examples=["Temperature Sensor Plaza Catalunya"])
     type: SensorType
-    latitude: float = Field(..., ge=-90, le=90, example=41.3851)
-    longitude: float = Field(..., ge=-180, le=180, example=2.1734)
+    latitude: float = Field(..., ge=-90, le=90, examples=[41.3851])
+    longitude: float = Field(..., ge=-180, le=180, examples=[2.1734])
     status: SensorStatus = SensorStatus.active
-    description: Optional[str] = Field(None, example="Environmental sensor for temperature monitoring")
+    description: Optional[str] = Field(None, examples=["Environmental sensor for temperature monitoring"])
 
 class SensorCreate(SensorBase):
     pass
@@ -65,38 +148,51 @@ class SensorUpdate(BaseModel):
     name: Optional[str] = None
     status: Optional[SensorStatus] = None
     description: Optional[str] = None
+    
+    @field_validator("name", "status")
+    @classmethod
+    def reject_null(cls, value):
+        # May be left out, but name and status can't be cleared
+        if value is None:
+            raise ValueError("may not be null")
+        return value
 
 class Sensor(SensorBase):
     id: int
-    created_at: datetime
-    last_reading: Optional[datetime] = None
+    created_at: int
+    last_reading: Optional[int] = None
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+_DATETIME_ADAPTER = TypeAdapter(datetime)
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 class SensorReading(BaseModel):
     sensor_id: int
-    value: float = Field(..., example=23.5)
-    unit: str = Field(..., example="°C")
-    timestamp: datetime = Field(default_factory=datetime.now)
+    value: float = Field(..., examples=[23.5])
+    unit: str = Field(..., examples=["°C"])
+    timestamp: int = Field(default_factory=now_ms, examples=[1700000000000])
     
+    @field_validator("timestamp", mode="before")
+    @classmethod
+    def parse_timestamp(cls, value):
+        # Accept what the former datetime field did, using pydantic's rules:
+        # ISO-8601 strings, and Unix time as seconds (up to 2e10) or milliseconds
+        parsed = _DATETIME_ADAPTER.validate_python(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.astimezone()
+        return (parsed - _EPOCH) // timedelta(milliseconds=1)
+
 class CityMetrics(BaseModel):
     city: str = "Barcelona"
     total_sensors: int
     active_sensors: int
     average_temperature: Optional[float] = None
     average_air_quality: Optional[float] = None
-    last_update: datetime
-
-# In-memory database (for demo purposes)
-sensors_db = []
-readings_db = []
-sensor_id_counter = 1
+    last_update: int
 
 # Initialize with sample data
-def init_sample_data():
-    global sensors_db, sensor_id_counter
-    
+async def init_sample_data():
     sample_sensors = [
         {
             "id": 1,
@@ -106,8 +202,8 @@ def init_sample_data():
             "longitude": 2.1744,
             "status": "active",
             "description": "Environmental monitoring near Sagrada Familia",
-            "created_at": datetime.now(),
-            "last_reading": datetime.now()
+            "created_at": now_ms(),
+            "last_reading": now_ms()
         },
         {
             "id": 2,
@@ -117,8 +213,8 @@ def init_sample_data():
             "longitude": 2.1734,
             "status": "active",
             "description": "Air quality monitoring in Eixample district",
-            "created_at": datetime.now(),
-            "last_reading": datetime.now()
+            "created_at": now_ms(),
+            "last_reading": now_ms()
         },
         {
             "id": 3,
@@ -128,49 +224,48 @@ def init_sample_data():
             "longitude": 2.1598,
             "status": "maintenance",
             "description": "Traffic monitoring on Gran Via",
-            "created_at": datetime.now(),
+            "created_at": now_ms(),
             "last_reading": None
         }
     ]
     
-    sensors_db = sample_sensors
-    sensor_id_counter = 4
-
-# Initialize sample data on startup
-init_sample_data()
+    await storage.load_sample_data(sample_sensors)
 
 # API Endpoints
 
+# The welcome payload never changes, so serialize it once
+_ROOT_BODY = orjson.dumps({
+    "message": "Welcome to Smart Cities Data API",
+    "version": "1.0.0",
+    "documentation": "/docs",
+    "endpoints": {
+        "sensors": "/api/v1/sensors",
+        "readings": "/api/v1/readings",
+        "metrics": "/api/v1/metrics"
+    }
+})
+
 @app.get("/", tags=["Root"])
 async def root():
     """
     Welcome endpoint with API information
     """
-    return {
-        "message": "Welcome to Smart Cities Data API",
-        "version": "1.0.0",
-        "documentation": "/docs",
-        "endpoints": {
-            "sensors": "/api/v1/sensors",
-            "readings": "/api/v1/readings",
-            "metrics": "/api/v1/metrics"
-        }
-    }
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 @app.get("/health", tags=["Health"])
 async def health_check():
     """
     Health check endpoint
     """
-    return {
+    return ORJSONResponse({
         "status": "healthy",
-        "timestamp": datetime.now(),
-        "sensors_count": len(sensors_db)
-    }
+        "timestamp": _now_cached,
+        "sensors_count": await storage.count_sensors()
+    })
 
 # Sensor CRUD Operations
 
-@app.get("/api/v1/sensors", response_model=List[Sensor], tags=["Sensors"])
+@app.get("/api/v1/sensors", response_model=List[Sensor], response_model_exclude_none=True, tags=["Sensors"])
 async def get_sensors(
     type: Optional[SensorType] = None,
     status: Optional[SensorStatus] = None,
@@ -179,57 +274,47 @@ async def get_sensors(
     """
     Get all sensors with optional filtering
     """
-    filtered_sensors = sensors_db
-    
-    if type:
-        filtered_sensors = [s for s in filtered_sensors if s["type"] == type]
-    
-    if status:
-        filtered_sensors = [s for s in filtered_sensors if s["status"] == status]
-    
-    return filtered_sensors[:limit]
+    # Storage compares against the plain string values, not the enums
+    return await storage.list_sensors(
+        type=type.value if type else None,
+        status=status.value if status else None,
+        limit=limit
+    )
 
-@app.get("/api/v1/sensors/{sensor_id}", response_model=Sensor, tags=["Sensors"])
+@app.get("/api/v1/sensors/{sensor_id}", response_model=Sensor, response_model_exclude_none=True, tags=["Sensors"])
 async def get_sensor(sensor_id: int):
     """
     Get a specific sensor by ID
     """
-    sensor = next((s for s in sensors_db if s["id"] == sensor_id), None)
+    sensor = await storage.get_sensor(sensor_id)
     if not sensor:
         raise HTTPException(status_code=404, detail=f"Sensor with ID {sensor_id} not found")
     return sensor
 
-@app.post("/api/v1/sensors", response_model=Sensor, tags=["Sensors"], status_code=201)
+@app.post("/api/v1/sensors", responses={201: {"model": Sensor}}, tags=["Sensors"], status_code=201)
 async def create_sensor(sensor: SensorCreate):
     """
     Create a new sensor
     """
-    global sensor_id_counter
-    
-    new_sensor = {
-        "id": sensor_id_counter,
-        **sensor.dict(),
-        "created_at": datetime.now(),
+    new_sensor = await storage.create_sensor({
+        **sensor.model_dump(mode="json"),
+        "created_at": now_ms(),
         "last_reading": None
-    }
-    
-    sensors_db.append(new_sensor)
-    sensor_id_counter += 1
+    })
+    await FastAPICache.clear(namespace=METRICS_CACHE_NAMESPACE)
     
     return new_sensor
 
-@app.put("/api/v1/sensors/{sensor_id}", response_model=Sensor, tags=["Sensors"])
+@app.put("/api/v1/sensors/{sensor_id}", responses={200: {"model": Sensor}}, tags=["Sensors"])
 async def update_sensor(sensor_id: int, sensor_update: SensorUpdate):
     """
     Update a sensor's information
     """
-    sensor = next((s for s in sensors_db if s["id"] == sensor_id), None)
+    update_data = sensor_update.model_dump(mode="json", exclude_unset=True)
+    sensor = await storage.update_sensor(sensor_id, update_data)
     if not sensor:
         raise HTTPException(status_code=404, detail=f"Sensor with ID {sensor_id} not found")
-    
-    update_data = sensor_update.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        sensor[field] = value
+    await FastAPICache.clear(namespace=METRICS_CACHE_NAMESPACE)
     
     return sensor
 
@@ -238,98 +323,111 @@ async def delete_sensor(sensor_id: int):
     """
     Delete a sensor
     """
-    global sensors_db
-    
-    sensor = next((s for s in sensors_db if s["id"] == sensor_id), None)
-    if not sensor:
+    if not await storage.delete_sensor(sensor_id):
         raise HTTPException(status_code=404, detail=f"Sensor with ID {sensor_id} not found")
     
-    sensors_db = [s for s in sensors_db if s["id"] != sensor_id]
+    await FastAPICache.clear(namespace=METRICS_CACHE_NAMESPACE)
     
     return {"message": f"Sensor {sensor_id} deleted successfully"}
 
 # Sensor Readings
 
-@app.post("/api/v1/readings", response_model=SensorReading, tags=["Readings"], status_code=201)
+@app.post("/api/v1/readings", responses={201: {"model": SensorReading}}, tags=["Readings"], status_code=201)
 async def create_reading(reading: SensorReading):
     """
     Submit a new sensor reading
     """
-    # Check if sensor exists
-    sensor = next((s for s in sensors_db if s["id"] == reading.sensor_id), None)
-    if not sensor:
+    # Store reading and update sensor's last reading time
+    if not await storage.add_reading(reading.model_dump()):
         raise HTTPException(status_code=404, detail=f"Sensor with ID {reading.sensor_id} not found")
     
-    # Update sensor's last reading time
-    sensor["last_reading"] = reading.timestamp
-    
-    # Store reading
-    readings_db.append(reading.dict())
-    
     return reading
 
+@app.post("/api/v1/readings/bulk", tags=["Readings"], status_code=201)
+async def create_readings(readings: List[SensorReading]):
+    """
+    Submit a batch of sensor readings in a single request
+    """
+    missing = await storage.add_readings([r.model_dump() for r in readings])
+    if missing:
+        ids = ", ".join(str(sensor_id) for sensor_id in missing)
+        raise HTTPException(status_code=404, detail=f"Sensors with IDs {ids} not found")
+    
+    return {"message": f"{len(readings)} readings submitted successfully", "count": len(readings)}
+
 @app.get("/api/v1/readings/{sensor_id}", response_model=List[SensorReading], tags=["Readings"])
 async def get_sensor_readings(sensor_id: int, limit: int = 100):
     """
     Get readings for a specific sensor
     """
-    sensor = next((s for s in sensors_db if s["id"] == sensor_id), None)
+    sensor = await storage.get_sensor(sensor_id)
     if not sensor:
         raise HTTPException(status_code=404, detail=f"Sensor with ID {sensor_id} not found")
     
-    sensor_readings = [r for r in readings_db if r["sensor_id"] == sensor_id]
-    return sensor_readings[-limit:]
+    return await storage.get_readings(sensor_id, limit)
 
 # City Metrics
 
-@app.get("/api/v1/metrics", response_model=CityMetrics, tags=["Metrics"])
+@app.get("/api/v1/metrics", response_model=CityMetrics, response_model_exclude_none=True, tags=["Metrics"])
+@cache(expire=5, namespace=METRICS_CACHE_NAMESPACE, coder=PickleCoder)
 async def get_city_metrics():
     """
     Get aggregated city metrics
     """
-    total_sensors = len(sensors_db)
-    active_sensors = len([s for s in sensors_db if s["status"] == "active"])
+    totals, actives = await storage.sensor_counts()
     
     # Calculate average temperature (mock data for demo)
-    temp_sensors = [s for s in sensors_db if s["type"] == "temperature" and s["status"] == "active"]
-    avg_temp = 22.5 if temp_sensors else None
+    avg_temp = 22.5 if actives[SensorType.temperature.value] else None
     
     # Calculate average air quality (mock data for demo)
-    air_sensors = [s for s in sensors_db if s["type"] == "air_quality" and s["status"] == "active"]
-    avg_air = 2.0 if air_sensors else None  # AQI scale 1-5
+    avg_air = 2.0 if actives[SensorType.air_quality.value] else None  # AQI scale 1-5
     
     return CityMetrics(
         city="Barcelona",
-        total_sensors=total_sensors,
-        active_sensors=active_sensors,
+        total_sensors=sum(totals.values()),
+        active_sensors=sum(actives.values()),
         average_temperature=avg_temp,
         average_air_quality=avg_air,
-        last_update=datetime.now()
+        last_update=_now_cached
     )
 
 @app.get("/api/v1/metrics/summary", tags=["Metrics"])
+@cache(expire=5, namespace=METRICS_CACHE_NAMESPACE, coder=PickleCoder)
 async def get_metrics_summary():
     """
     Get a summary of all sensor types and their counts
     """
+    totals, actives = await storage.sensor_counts()
+    
     summary = {}
     
     for sensor_type in SensorType:
-        type_sensors = [s for s in sensors_db if s["type"] == sensor_type]
-        active_count = len([s for s in type_sensors if s["status"] == "active"])
+        total_count = totals[sensor_type.value]
+        active_count = actives[sensor_type.value]
         
         summary[sensor_type] = {
-            "total": len(type_sensors),
+            "total": total_count,
             "active": active_count,
-            "percentage_active": round((active_count / len(type_sensors) * 100) if type_sensors else 0, 2)
+            "percentage_active": round((active_count / total_count * 100) if total_count else 0, 2)
         }
     
     return {
         "summary": summary,
-        "total_sensors": len(sensors_db),
-        "timestamp": datetime.now()
+        "total_sensors": sum(totals.values()),
+        "timestamp": _now_cached
     }
 
 # Run the application
+# uvicorn picks uvloop and httptools automatically when installed (uvicorn[standard])
+# Without Redis each worker would keep its own in-memory database, so
+# WEB_CONCURRENCY defaults to a single worker in that case
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    import uvicorn
+    
+    default_workers = os.cpu_count() if REDIS_URL else 1
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.environ.get("WEB_CONCURRENCY", default_workers))
+    )
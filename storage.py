@@ -0,0 +1,417 @@
+"""
+Storage backends for the Smart Cities Data API
+In-memory by default, Redis when several workers need to share state
+"""
+
+from typing import Optional, List, Dict, Tuple
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from uuid import uuid4
+import orjson
+import redis.asyncio as aioredis
+
+# Keep only the newest readings of each sensor so memory stays bounded.
+# Both backends order readings by timestamp and evict the oldest timestamps,
+# so backfilled readings land in place rather than at the end.
+MAX_READINGS_PER_SENSOR = 10_000
+
+
+def _group_by_sensor(readings: List[dict]) -> Dict[int, List[dict]]:
+    groups = defaultdict(list)
+    for reading in readings:
+        groups[reading["sensor_id"]].append(reading)
+    return groups
+
+
+class InMemoryStorage:
+    """
+    In-memory storage (for demo purposes), local to each worker process
+    """
+
+    def __init__(self):
+        self.sensors_db: List[dict] = []
+        self.sensors_by_id: Dict[int, dict] = {}
+        # Most recent readings per sensor in timestamp order, with their timestamps
+        # alongside for bisecting
+        self.readings_by_sensor: Dict[int, List[dict]] = defaultdict(list)
+        self.timestamps_by_sensor: Dict[int, List[int]] = defaultdict(list)
+        self.sensor_id_counter = 1
+        # Per-type counters for the metrics, kept in step on every write
+        self.type_totals, self.type_actives = Counter(), Counter()
+
+    async def load_sample_data(self, sample_sensors: List[dict]):
+        self.sensors_db = list(sample_sensors)
+        self.sensors_by_id = {s["id"]: s for s in sample_sensors}
+        self.sensor_id_counter = max(self.sensors_by_id, default=0) + 1
+
+        self.type_totals, self.type_actives = Counter(), Counter()
+        for sensor in sample_sensors:
+            self._count_sensor(sensor, 1)
+
+    def _count_sensor(self, sensor: dict, delta: int):
+        self.type_totals[sensor["type"]] += delta
+        if sensor["status"] == "active":
+            self.type_actives[sensor["type"]] += delta
+
+    async def close(self):
+        pass
+
+    async def count_sensors(self) -> int:
+        return len(self.sensors_db)
+
+    async def list_sensors(self, type: Optional[str] = None, status: Optional[str] = None, limit: int = 100) -> List[dict]:
+        filtered_sensors = self.sensors_db
+
+        if type:
+            filtered_sensors = [s for s in filtered_sensors if s["type"] == type]
+
+        if status:
+            filtered_sensors = [s for s in filtered_sensors if s["status"] == status]
+
+        return filtered_sensors[:limit]
+
+    async def get_sensor(self, sensor_id: int) -> Optional[dict]:
+        return self.sensors_by_id.get(sensor_id)
+
+    async def create_sensor(self, data: dict) -> dict:
+        sensor = {"id": self.sensor_id_counter, **data}
+        self.sensors_db.append(sensor)
+        self.sensors_by_id[sensor["id"]] = sensor
+        self.sensor_id_counter += 1
+        self._count_sensor(sensor, 1)
+        return sensor
+
+    async def update_sensor(self, sensor_id: int, update_data: dict) -> Optional[dict]:
+        sensor = self.sensors_by_id.get(sensor_id)
+        if not sensor:
+            return None
+
+        self._count_sensor(sensor, -1)
+        for field, value in update_data.items():
+            sensor[field] = value
+        self._count_sensor(sensor, 1)
+        return sensor
+
+    async def delete_sensor(self, sensor_id: int) -> bool:
+        sensor = self.sensors_by_id.pop(sensor_id, None)
+        if not sensor:
+            return False
+
+        self.sensors_db.remove(sensor)
+        self.readings_by_sensor.pop(sensor_id, None)
+        self.timestamps_by_sensor.pop(sensor_id, None)
+        self._count_sensor(sensor, -1)
+        return True
+
+    async def add_reading(self, reading: dict) -> bool:
+        sensor = self.sensors_by_id.get(reading["sensor_id"])
+        if not sensor:
+            return False
+
+        sensor["last_reading"] = max(sensor["last_reading"] or reading["timestamp"], reading["timestamp"])
+        self._insert_readings(reading["sensor_id"], [reading])
+        return True
+
+    async def add_readings(self, readings: List[dict]) -> List[int]:
+        """
+        Store a batch of readings, or none of them if any sensor is unknown
+
+        Returns the IDs of the unknown sensors.
+        """
+        groups = _group_by_sensor(readings)
+        missing = [sensor_id for sensor_id in groups if sensor_id not in self.sensors_by_id]
+        if missing:
+            return missing
+
+        for sensor_id, sensor_readings in groups.items():
+            sensor = self.sensors_by_id[sensor_id]
+            # A backfilled batch never moves last_reading backwards
+            newest = max(r["timestamp"] for r in sensor_readings)
+            sensor["last_reading"] = max(sensor["last_reading"] or newest, newest)
+            self._insert_readings(sensor_id, sensor_readings)
+        return []
+
+    def _insert_readings(self, sensor_id: int, readings: List[dict]):
+        buffer = self.readings_by_sensor[sensor_id]
+        timestamps = self.timestamps_by_sensor[sensor_id]
+
+        for reading in readings:
+            # In-order readings land at the end, so this is usually an append
+            index = bisect_right(timestamps, reading["timestamp"])
+            timestamps.insert(index, reading["timestamp"])
+            buffer.insert(index, reading)
+
+        # Evict the oldest timestamps beyond MAX_READINGS_PER_SENSOR
+        excess = len(buffer) - MAX_READINGS_PER_SENSOR
+        if excess > 0:
+            del buffer[:excess]
+            del timestamps[:excess]
+
+    async def get_readings(self, sensor_id: int, limit: int = 100) -> List[dict]:
+        if limit <= 0:
+            return []
+
+        return self.readings_by_sensor.get(sensor_id, [])[-limit:]
+
+    async def sensor_counts(self) -> Tuple[Counter, Counter]:
+        """
+        Total and active sensor counts per sensor type
+        """
+        return Counter(self.type_totals), Counter(self.type_actives)
+
+
+# Redis keys
+SENSOR_KEY = "sensor:{}"
+SENSOR_ID_SEQ_KEY = "sensor:id_seq"
+SENSORS_KEY = "sensors"
+SENSOR_STATS_KEY = "sensors:stats"
+READINGS_KEY = "readings:{}"
+
+
+# Set last_reading only if it moves forwards, runs inside the MULTI
+_SET_LAST_READING_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], 'last_reading'))
+if not current or tonumber(ARGV[1]) > current then
+    redis.call('HSET', KEYS[1], 'last_reading', ARGV[1])
+end
+"""
+
+
+def _encode_sensor(sensor: dict) -> dict:
+    # Redis hashes can't hold None, missing fields are read back as None
+    return {field: value for field, value in sensor.items() if value is not None}
+
+
+def _decode_sensor(data: dict) -> dict:
+    last_reading = data.get("last_reading")
+    return {
+        "id": int(data["id"]),
+        "name": data["name"],
+        "type": data["type"],
+        "latitude": float(data["latitude"]),
+        "longitude": float(data["longitude"]),
+        "status": data["status"],
+        "description": data.get("description"),
+        "created_at": int(data["created_at"]),
+        "last_reading": int(last_reading) if last_reading else None
+    }
+
+
+def _encode_reading(reading: dict) -> str:
+    # Sorted-set members are unique, prefix each reading so duplicates are kept
+    return f"{uuid4().hex}:{orjson.dumps(reading).decode()}"
+
+
+def _decode_reading(member: str) -> dict:
+    return orjson.loads(member.split(":", 1)[1])
+
+
+class RedisStorage:
+    """
+    Redis storage shared by all worker processes
+
+    Sensors are hashes (sensor:{id}) indexed by the sensors sorted set,
+    readings are time-ordered sorted sets (readings:{sensor_id}) and
+    per-type counters for the metrics live in the sensors:stats hash.
+    Readings sharing a timestamp may come back in any order.
+    """
+
+    def __init__(self, redis: aioredis.Redis):
+        self.redis = redis
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisStorage":
+        return cls(aioredis.from_url(url, decode_responses=True))
+
+    async def load_sample_data(self, sample_sensors: List[dict]):
+        # Only the first worker to start seeds an empty database
+        last_id = max((s["id"] for s in sample_sensors), default=0)
+        if not await self.redis.set(SENSOR_ID_SEQ_KEY, last_id, nx=True):
+            return
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for sensor in sample_sensors:
+                self._queue_sensor_insert(pipe, sensor)
+            await pipe.execute()
+
+    async def close(self):
+        await self.redis.aclose()
+
+    def _queue_sensor_insert(self, pipe, sensor: dict):
+        pipe.hset(SENSOR_KEY.format(sensor["id"]), mapping=_encode_sensor(sensor))
+        pipe.zadd(SENSORS_KEY, {sensor["id"]: sensor["id"]})
+        pipe.hincrby(SENSOR_STATS_KEY, f"total:{sensor['type']}", 1)
+        if sensor["status"] == "active":
+            pipe.hincrby(SENSOR_STATS_KEY, f"active:{sensor['type']}", 1)
+
+    async def count_sensors(self) -> int:
+        return await self.redis.zcard(SENSORS_KEY)
+
+    async def list_sensors(self, type: Optional[str] = None, status: Optional[str] = None, limit: int = 100) -> List[dict]:
+        if limit <= 0:
+            return []
+
+        # Without filters only the first `limit` sensors need to be fetched
+        filtered = type or status
+        sensor_ids = await self.redis.zrange(SENSORS_KEY, 0, -1 if filtered else limit - 1)
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for sensor_id in sensor_ids:
+                pipe.hgetall(SENSOR_KEY.format(sensor_id))
+            results = await pipe.execute()
+
+        sensors = [_decode_sensor(data) for data in results if data]
+
+        if type:
+            sensors = [s for s in sensors if s["type"] == type]
+
+        if status:
+            sensors = [s for s in sensors if s["status"] == status]
+
+        return sensors[:limit]
+
+    async def get_sensor(self, sensor_id: int) -> Optional[dict]:
+        data = await self.redis.hgetall(SENSOR_KEY.format(sensor_id))
+        return _decode_sensor(data) if data else None
+
+    async def create_sensor(self, data: dict) -> dict:
+        sensor_id = await self.redis.incr(SENSOR_ID_SEQ_KEY)
+        sensor = {"id": sensor_id, **data}
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self._queue_sensor_insert(pipe, sensor)
+            await pipe.execute()
+
+        return sensor
+
+    async def update_sensor(self, sensor_id: int, update_data: dict) -> Optional[dict]:
+        key = SENSOR_KEY.format(sensor_id)
+        to_set = {f: v for f, v in update_data.items() if v is not None}
+        # Only the description is optional, required fields are never removed
+        clear_description = "description" in update_data and update_data["description"] is None
+
+        async def update(pipe) -> Optional[dict]:
+            data = await pipe.hgetall(key)
+            if not data:
+                return None
+
+            sensor = _decode_sensor(data)
+            previous_status = sensor["status"]
+            sensor.update(to_set)
+            if clear_description:
+                sensor["description"] = None
+
+            pipe.multi()
+            if to_set:
+                pipe.hset(key, mapping=to_set)
+            if clear_description:
+                pipe.hdel(key, "description")
+
+            # Keep the active counters in step with status changes
+            was_active = previous_status == "active"
+            is_active = sensor["status"] == "active"
+            if was_active != is_active:
+                pipe.hincrby(SENSOR_STATS_KEY, f"active:{sensor['type']}", 1 if is_active else -1)
+
+            return sensor
+
+        # WATCH the sensor so a concurrent update or delete makes this retry
+        return await self.redis.transaction(update, key, value_from_callable=True)
+
+    async def delete_sensor(self, sensor_id: int) -> bool:
+        key = SENSOR_KEY.format(sensor_id)
+
+        async def delete(pipe) -> bool:
+            sensor_type, status = await pipe.hmget(key, "type", "status")
+            if sensor_type is None:
+                return False
+
+            pipe.multi()
+            pipe.delete(key, READINGS_KEY.format(sensor_id))
+            pipe.zrem(SENSORS_KEY, sensor_id)
+            pipe.hincrby(SENSOR_STATS_KEY, f"total:{sensor_type}", -1)
+            if status == "active":
+                pipe.hincrby(SENSOR_STATS_KEY, f"active:{sensor_type}", -1)
+            return True
+
+        return await self.redis.transaction(delete, key, value_from_callable=True)
+
+    async def add_reading(self, reading: dict) -> bool:
+        sensor_key = SENSOR_KEY.format(reading["sensor_id"])
+        readings_key = READINGS_KEY.format(reading["sensor_id"])
+        timestamp = reading["timestamp"]
+        member = _encode_reading(reading)
+
+        async def add(pipe) -> bool:
+            if not await pipe.exists(sensor_key):
+                return False
+
+            # All writes go out in one round trip
+            pipe.multi()
+            pipe.eval(_SET_LAST_READING_SCRIPT, 1, sensor_key, timestamp)
+            pipe.zadd(readings_key, {member: timestamp})
+            # Keep only the newest MAX_READINGS_PER_SENSOR readings
+            pipe.zremrangebyrank(readings_key, 0, -MAX_READINGS_PER_SENSOR - 1)
+            return True
+
+        # WATCH the sensor so a concurrent delete can't be undone by these writes
+        return await self.redis.transaction(add, sensor_key, value_from_callable=True)
+
+    async def add_readings(self, readings: List[dict]) -> List[int]:
+        """
+        Store a batch of readings, or none of them if any sensor is unknown
+
+        Returns the IDs of the unknown sensors.
+        """
+        groups = _group_by_sensor(readings)
+        if not groups:
+            return []
+
+        sensor_keys = [SENSOR_KEY.format(sensor_id) for sensor_id in groups]
+
+        async def add(pipe) -> List[int]:
+            # Check every sensor in one round trip. The keys are already
+            # WATCHed, so EXEC still fails if one changes after this check.
+            async with self.redis.pipeline(transaction=False) as check:
+                for key in sensor_keys:
+                    check.exists(key)
+                found = await check.execute()
+
+            missing = [sensor_id for sensor_id, exists in zip(groups, found) if not exists]
+            if missing:
+                return missing
+
+            # One ZADD per sensor, all in a single round trip
+            pipe.multi()
+            for sensor_id, sensor_readings in groups.items():
+                readings_key = READINGS_KEY.format(sensor_id)
+                last_reading = max(r["timestamp"] for r in sensor_readings)
+                pipe.eval(_SET_LAST_READING_SCRIPT, 1, SENSOR_KEY.format(sensor_id), last_reading)
+                pipe.zadd(readings_key, {_encode_reading(r): r["timestamp"] for r in sensor_readings})
+                pipe.zremrangebyrank(readings_key, 0, -MAX_READINGS_PER_SENSOR - 1)
+            return []
+
+        # WATCH every sensor so a concurrent delete can't be undone by these writes
+        return await self.redis.transaction(add, *sensor_keys, value_from_callable=True)
+
+    async def get_readings(self, sensor_id: int, limit: int = 100) -> List[dict]:
+        if limit <= 0:
+            return []
+
+        members = await self.redis.zrange(READINGS_KEY.format(sensor_id), -limit, -1)
+        return [_decode_reading(member) for member in members]
+
+    async def sensor_counts(self) -> Tuple[Counter, Counter]:
+        """
+        Total and active sensor counts per sensor type
+        """
+        totals, actives = Counter(), Counter()
+
+        for field, count in (await self.redis.hgetall(SENSOR_STATS_KEY)).items():
+            kind, sensor_type = field.split(":", 1)
+            if kind == "total":
+                totals[sensor_type] = int(count)
+            else:
+                actives[sensor_type] = int(count)
+
+        return totals, actives